@@ -82,3 +82,43 @@ def optimizer_to(optimizer, device):
             if isinstance(v, torch.Tensor):
                 state[k] = v.to(device=device)
     return optimizer
+
+
+class CudaPrefetcher:
+    """
+    Iterate a dataloader, copying batch N+1 to device on a side stream
+    while batch N is being consumed. Falls back to plain copies on the
+    current stream for non-CUDA devices.
+    """
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.stream = None
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return dict_apply(batch, lambda x: x.to(self.device, non_blocking=True))
+        with torch.cuda.stream(self.stream):
+            return dict_apply(batch, lambda x: x.to(self.device, non_blocking=True))
+
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                # memory was allocated on the side stream but is used on the current one
+                dict_apply(batch, lambda x: x.record_stream(current_stream))
+            next_batch = self._preload(iterator)
+            yield batch
@@ -2,6 +2,69 @@ import copy
 import torch
 import numpy as np
 
+
+def std_to_exp(std):
+    """
+    Solve x^3 + 7x^2 + (16 - std^-2)x + (12 - std^-2) = 0 for the power
+    function exponent of each relative std, taking the largest real part
+    among its roots.
+    The cubic is solved in closed form: substituting x = y - 7/3 gives the
+    depressed cubic y^3 + py + q = 0, whose largest real root is found with
+    the trigonometric method when all three roots are real and with
+    Cardano's formula otherwise.
+    """
+    std = np.asarray(std, dtype=np.float64)
+    tmp = std.flatten() ** -2
+    c = 16 - tmp
+    d = 12 - tmp
+    p = c - 49 / 3
+    q = (686 - 63 * c + 27 * d) / 27
+    disc = -(4 * p ** 3 + 27 * q ** 2)
+
+    y = np.empty_like(tmp)
+    real = disc >= 0
+    # three real roots (p < 0), k=0 is the largest
+    pr, qr = p[real], q[real]
+    m = 2 * np.sqrt(-pr / 3)
+    arg = np.clip(3 * qr / (pr * m), -1, 1)
+    y[real] = m * np.cos(np.arccos(arg) / 3)
+    # single real root, the complex pair has real part -y/2
+    pc, qc = p[~real], q[~real]
+    s = np.sqrt(qc ** 2 / 4 + pc ** 3 / 27)
+    yc = np.cbrt(-qc / 2 + s) + np.cbrt(-qc / 2 - s)
+    y[~real] = np.maximum(yc, -yc / 2)
+
+    exp = (y - 7 / 3).reshape(std.shape)
+    return exp
+
+
+@torch.no_grad()
+def _ema_update(new_model, averaged_model, decay):
+    """
+    averaged = decay * averaged + (1 - decay) * new, applied to all
+    trainable parameters at once with multi-tensor foreach kernels.
+    """
+    ema_params = list()
+    new_params = list()
+    for module, ema_module in zip(new_model.modules(), averaged_model.modules()):
+        for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
+            # iterative over immediate parameters only.
+            if isinstance(param, dict):
+                raise RuntimeError('Dict parameter not supported')
+            elif not param.requires_grad:
+                ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+            else:
+                ema_params.append(ema_param)
+                new_params.append(param.data.to(dtype=ema_param.dtype))
+
+    if len(ema_params) > 0:
+        torch._foreach_mul_(ema_params, decay)
+        torch._foreach_add_(ema_params, new_params, alpha=1 - decay)
+
+    for p_net, p_ema in zip(new_model.buffers(), averaged_model.buffers()):
+        p_ema.copy_(p_net)
+
+
 class EMAModel:
     """
     Exponential Moving Average of models weights
@@ -64,21 +127,7 @@ class EMAModel:
     @torch.no_grad()
     def step(self, new_model):
         self.decay = self.get_decay(self.optimization_step)
-
-        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):            
-            for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
-                # iterative over immediate parameters only.
-                if isinstance(param, dict):
-                    raise RuntimeError('Dict parameter not supported')
-                elif not param.requires_grad:
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - self.decay)
-        
-        for p_net, p_ema in zip(new_model.buffers(), self.averaged_model.buffers()):
-            p_ema.copy_(p_net)
-
+        _ema_update(new_model, self.averaged_model, self.decay)
         self.optimization_step += 1
 
     def state_dict(self):
@@ -106,6 +155,7 @@ class PowerModel:
         self.model = model
         self.averaged_models = [copy.deepcopy(model) for _ in stds]
         self.stds = stds
+        self.gammas = self.std_to_exp(stds)
         for averaged_model in self.averaged_models:
             averaged_model.eval()
             averaged_model.requires_grad_(False)
@@ -113,17 +163,18 @@ class PowerModel:
         self.optimization_step = 1
 
     def std_to_exp(self, std):
-        tmp = std ** -2
-        exp = np.roots([1, 7, 16 - tmp, 12 -tmp]).real.max()
-        return exp
+        return std_to_exp(std)
 
 
     def get_decay(self, gamma):
         """
         Compute the decay factor for the exponential moving average.
+        Accepts an array of gammas, sharing one log across all of them.
         """
-
-        beta = (1 - 1/self.optimization_step) ** (gamma + 1) 
+        with np.errstate(divide='ignore'):
+            # log(0) = -inf at the first step gives beta = 0 as before
+            log_base = np.log1p(-1 / self.optimization_step)
+        beta = np.exp((np.asarray(gamma) + 1) * log_base)
         return beta
 
     def to(self, device):
@@ -136,23 +187,9 @@ class PowerModel:
 
     @torch.no_grad()
     def step(self, new_model):
-        for std, ema in zip(self.stds, self.averaged_models):
-            gamma = self.std_to_exp(std)
-            decay = self.get_decay(gamma)
-
-            for module, ema_module in zip(new_model.modules(), ema.modules()):            
-                for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
-                    # iterative over immediate parameters only.
-                    if isinstance(param, dict):
-                        raise RuntimeError('Dict parameter not supported')
-                    elif not param.requires_grad:
-                        ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                    else:
-                        ema_param.mul_(decay)
-                        ema_param.add_(param.data.to(dtype=ema_param.dtype).data, alpha=(1 - decay))
-    
-            for p_net, p_ema in zip(new_model.buffers(), ema.buffers()):
-                p_ema.copy_(p_net)
+        decays = self.get_decay(self.gammas)
+        for decay, ema in zip(decays, self.averaged_models):
+            _ema_update(new_model, ema, float(decay))
 
         self.optimization_step += 1
 
@@ -165,6 +202,7 @@ class PowerModel:
 
     def load_state_dict(self, state_dict):
         self.stds = state_dict['stds']
+        self.gammas = self.std_to_exp(self.stds)
         self.optimization_step = state_dict['optimization_step']
         for model, model_state_dict in zip(self.averaged_models, state_dict['averaged_models']):
             model.load_state_dict(model_state_dict)
@@ -104,7 +104,9 @@ class BaseWorkspace:
             path = self.get_checkpoint_path(tag=tag)
         else:
             path = pathlib.Path(path)
-        payload = torch.load(path.open('rb'), pickle_module=dill, **kwargs)
+        # mmap so tensors are paged in on demand by load_state_dict
+        # instead of reading the whole file up front
+        payload = torch.load(str(path), pickle_module=dill, mmap=True, **kwargs)
         self.load_payload(payload, 
             exclude_keys=exclude_keys, 
             include_keys=include_keys)
@@ -115,7 +117,7 @@ class BaseWorkspace:
             exclude_keys=None, 
             include_keys=None,
             **kwargs):
-        payload = torch.load(open(path, 'rb'), pickle_module=dill)
+        payload = torch.load(str(path), pickle_module=dill, mmap=True)
         instance = cls(payload['cfg'])
         instance.load_payload(
             payload=payload, 
@@ -8,6 +8,7 @@ if __name__ == "__main__":
     os.chdir(ROOT_DIR)
 
 import os
+import warnings
 import hydra
 import torch
 from omegaconf import OmegaConf, DictConfig
@@ -24,7 +25,7 @@ from diffusion_policy.dataset.base_dataset import BaseDataset
 from diffusion_policy.env_runner.base_runner import BaseRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, CudaPrefetcher
 from diffusion_policy.model.diffusion.ema_model import EMAModel
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
 
@@ -69,6 +70,7 @@ class TrainWorkspace(BaseWorkspace):
             cfg.training.checkpoint_every = 1
             cfg.training.val_every = 1
             cfg.training.sample_every = 1
+            cfg.training.compile = False
             cfg.dataloader.batch_size = 4
             cfg.val_dataloader.batch_size = 4
             cfg.checkpoint.save_last_ckpt = True
@@ -97,8 +99,20 @@ class TrainWorkspace(BaseWorkspace):
         val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
 
         val_sampler = RandomSampler(val_dataset, replacement=True)
+        # only one batch is drawn per sampling epoch, so use at most a single
+        # persistent worker with the smallest prefetch. the worker still loads
+        # one replacement batch after each draw, which is discarded on reset
+        val_sampler_workers = dict()
+        if cfg.val_dataloader.num_workers > 0:
+            val_sampler_workers = dict(
+                num_workers=1, persistent_workers=True, prefetch_factor=1
+            )
         val_sampler_dataloader = DataLoader(
-            val_dataset, sampler=val_sampler, batch_size=cfg.dataloader.batch_size
+            val_dataset,
+            sampler=val_sampler,
+            batch_size=cfg.dataloader.batch_size,
+            pin_memory=cfg.val_dataloader.pin_memory,
+            **val_sampler_workers,
         )
 
         self.model.set_normalizer(normalizer)
@@ -115,7 +129,13 @@ class TrainWorkspace(BaseWorkspace):
         # device transfer
         device = torch.device(cfg.training.device)
         self.model.to(device)
-        # self.model = torch.compile(self.model, mode="reduce-overhead")
+        # compile only the training forward, self.model stays the eager module
+        # so ema, checkpointing and evaluation see the same parameters.
+        # cudagraph modes are avoided since buffered train_loss tensors
+        # would be overwritten by the next graph replay.
+        compute_loss = self.model.compute_loss
+        if cfg.training.compile:
+            compute_loss = torch.compile(compute_loss, dynamic=False)
         # self.ema = hydra.utils.instantiate(cfg.ema, model=self.model)
         self.ema.to(device)
 
@@ -154,9 +174,36 @@ class TrainWorkspace(BaseWorkspace):
 
         optimizer_to(self.optimizer, device)
 
+        # mixed precision, amp_dtype: null runs in full precision
+        # only bfloat16 is supported, float16 would need a GradScaler
+        amp_dtype = cfg.training.amp_dtype
+        if amp_dtype not in (None, "bfloat16"):
+            raise ValueError(
+                f"Unsupported training.amp_dtype {amp_dtype!r}, "
+                "expected null or bfloat16"
+            )
+        if (
+            amp_dtype == "bfloat16"
+            and device.type == "cuda"
+            and torch.cuda.get_device_capability(device)[0] < 8
+        ):
+            warnings.warn(
+                f"amp_dtype=bfloat16 is not supported on {device}, "
+                "running in full precision"
+            )
+            amp_dtype = None
+        amp_kwargs = dict(
+            device_type=device.type,
+            dtype=torch.bfloat16,
+            enabled=amp_dtype is not None,
+        )
+
         # save batch for sampling
         train_sampling_batch = None
-        
+
+        # step logs whose train_loss is still a device tensor
+        pending_step_logs = list()
+
 
         # training loop
         log_path = os.path.join(self.output_dir, "logs.json.txt")
@@ -173,21 +220,24 @@ class TrainWorkspace(BaseWorkspace):
 
                 self.model.train()
                 with tqdm.tqdm(
-                    train_dataloader,
+                    CudaPrefetcher(train_dataloader, device),
                     desc=f"Training epoch {self.epoch}",
                     leave=False,
                     mininterval=cfg.training.tqdm_interval_sec,
                 ) as tepoch:
+                    # device transfer overlapped by the prefetcher
                     for batch_idx, batch in enumerate(tepoch):
-                        # device transfer
-                        batch = dict_apply(
-                            batch, lambda x: x.to(device, non_blocking=True)
-                        )
                         if train_sampling_batch is None:
                             train_sampling_batch = batch
 
                         # compute loss
-                        raw_loss = self.model.compute_loss(batch)
+                        # compute_loss is compiled for the full batch shape, a
+                        # short final batch runs eagerly instead of recompiling
+                        batch_compute_loss = compute_loss
+                        if batch["action"].shape[0] != cfg.dataloader.batch_size:
+                            batch_compute_loss = self.model.compute_loss
+                        with torch.autocast(**amp_kwargs):
+                            raw_loss = batch_compute_loss(batch)
                         loss = raw_loss / cfg.training.gradient_accumulate_every
                         loss.backward()
 
@@ -205,10 +255,10 @@ class TrainWorkspace(BaseWorkspace):
                             self.ema.step(self.model)
 
                         # logging
-                        raw_loss_cpu = raw_loss.item()
-                        tepoch.set_postfix(loss=raw_loss_cpu, refresh=False)
+                        # train_loss stays on device until flushed to avoid
+                        # a sync every step
                         step_log = {
-                            "train_loss": raw_loss_cpu,
+                            "train_loss": raw_loss.detach(),
                             "global_step": self.global_step,
                             "epoch": self.epoch,
                             "lr": lr_scheduler.get_last_lr()[0],
@@ -217,8 +267,11 @@ class TrainWorkspace(BaseWorkspace):
                         is_last_batch = batch_idx == (len(train_dataloader) - 1)
                         if not is_last_batch:
                             # log of last step is combined with validation and rollout
-                            wandb_run.log(step_log, step=self.global_step)
-                            json_logger.log(step_log)
+                            pending_step_logs.append(step_log)
+                            if len(pending_step_logs) >= cfg.training.log_every:
+                                _flush_step_logs(
+                                    pending_step_logs, wandb_run, json_logger, tepoch
+                                )
                             self.global_step += 1
 
                         if (cfg.training.max_train_steps is not None) and batch_idx >= (
@@ -226,6 +279,11 @@ class TrainWorkspace(BaseWorkspace):
                         ):
                             break
 
+                    _flush_step_logs(pending_step_logs, wandb_run, json_logger, tepoch)
+
+                if isinstance(step_log.get("train_loss"), torch.Tensor):
+                    step_log["train_loss"] = step_log["train_loss"].item()
+
                 # ========= eval for this epoch ==========
                 policy = self.model
                 if cfg.training.use_ema:
@@ -245,38 +303,34 @@ class TrainWorkspace(BaseWorkspace):
                 # run validation
                 if (self.epoch % cfg.training.val_every) == 0:
                     self.model.eval()
-                    with torch.no_grad():
-                        val_losses = list()
+                    with torch.no_grad(), torch.autocast(**amp_kwargs):
+                        val_loss_sum = 0.0
+                        val_count = 0
                         with tqdm.tqdm(
-                            val_dataloader,
+                            CudaPrefetcher(val_dataloader, device),
                             desc=f"Validation epoch {self.epoch}",
                             leave=False,
                             mininterval=cfg.training.tqdm_interval_sec,
                         ) as tepoch:
                             for batch_idx, batch in enumerate(tepoch):
-                                batch = dict_apply(
-                                    batch, lambda x: x.to(device, non_blocking=True)
-                                )
-
                                 loss = self.model.compute_loss(batch)
-                                val_losses.append(loss)
+                                val_loss_sum += loss.item()
+                                val_count += 1
                                 if (
                                     cfg.training.max_val_steps is not None
                                 ) and batch_idx >= (cfg.training.max_val_steps - 1):
                                     break
-                        if len(val_losses) > 0:
-                            val_loss = torch.mean(torch.tensor(val_losses)).item()
+                        if val_count > 0:
+                            val_loss = val_loss_sum / val_count
                             # log epoch average validation loss
                             step_log["val_loss"] = val_loss
 
                 # run diffusion sampling on a training batch
                 if (self.epoch % cfg.training.sample_every) == 0:
-                    with torch.no_grad():
+                    with torch.no_grad(), torch.autocast(**amp_kwargs):
                         # sample trajectory from training set, and evaluate difference
-                        batch = dict_apply(
-                            train_sampling_batch,
-                            lambda x: x.to(device, non_blocking=True),
-                        )
+                        # train_sampling_batch is already on device
+                        batch = train_sampling_batch
                         obs_dict = {"obs": batch["obs"]}
                         gt_action = batch["action"]
 
@@ -284,12 +338,6 @@ class TrainWorkspace(BaseWorkspace):
                         pred_action = result["action_pred"]
                         mse = torch.nn.functional.mse_loss(pred_action, gt_action)
                         step_log["train_action_mse_error"] = mse.item()
-                        del batch
-                        del obs_dict
-                        del gt_action
-                        del result
-                        del pred_action
-                        del mse
                         # sample trajectory from val set, and evaluate difference
                         for val_sampling_batch in val_sampler_dataloader:
                             batch = dict_apply(
@@ -304,12 +352,6 @@ class TrainWorkspace(BaseWorkspace):
                             pred_action = result["action_pred"]
                             mse = torch.nn.functional.mse_loss(pred_action, gt_action)
                             step_log["val_action_mse_error"] = mse.item()
-                            del batch
-                            del obs_dict
-                            del gt_action
-                            del result
-                            del pred_action
-                            del mse
 
                             # single batch
                             break
@@ -322,7 +364,12 @@ class TrainWorkspace(BaseWorkspace):
 
                 # checkpoint
                 if (self.epoch % cfg.training.checkpoint_every) == 0:
-                    self.save_checkpoint(tag=f"epoch_{self.epoch}")
+                    # epoch checkpoints are for evaluation, resume uses latest,
+                    # so skip the optimizer state (2x the model size for adam)
+                    self.save_checkpoint(
+                        tag=f"epoch_{self.epoch}",
+                        exclude_keys=tuple(self.exclude_keys) + ("optimizer",),
+                    )
 
                 policy.train()
 
@@ -336,6 +383,21 @@ class TrainWorkspace(BaseWorkspace):
             env_runner.close()
 
 
+def _flush_step_logs(pending_step_logs, wandb_run, json_logger, tepoch):
+    if len(pending_step_logs) == 0:
+        return
+    # single device sync for all buffered train losses
+    losses = torch.stack(
+        [step_log["train_loss"] for step_log in pending_step_logs]
+    ).cpu().tolist()
+    for step_log, loss in zip(pending_step_logs, losses):
+        step_log["train_loss"] = loss
+        wandb_run.log(step_log, step=step_log["global_step"])
+        json_logger.log(step_log)
+    tepoch.set_postfix(loss=losses[-1], refresh=False)
+    pending_step_logs.clear()
+
+
 @hydra.main(
     version_base=None,
     config_path=str(pathlib.Path(__file__).parent.parent.joinpath("config")),
@@ -39,6 +39,7 @@ import dill
 import wandb
 import json
 import random
+import functools
 from io import StringIO
 from csv import writer
 import pandas as pd
@@ -67,23 +68,36 @@ class Collector:
         self.t.append(t.detach().to("cpu").numpy())
 
 
-def generate(checkpoint, output_dir, save_traj, device='cuda:0', generation_file=None, num_samples=100, w=1):
-    #if os.path.exists(output_dir):
-    #    click.confirm(f"Output path {output_dir} already exists! Overwrite?", abort=True)
-    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
-    
-    # load checkpoint
-    payload = torch.load(open(checkpoint, 'rb'), pickle_module=dill)
+@functools.lru_cache(maxsize=1)
+def load_workspace(checkpoint, output_dir):
+    # cached so repeated generate calls on the same checkpoint
+    # (e.g. sweeping w in pw_experiment) only deserialize it once.
+    # the returned workspace is shared between calls, callers must not
+    # modify it (beyond the idempotent policy.to(device)/eval() in generate)
+    payload = torch.load(str(checkpoint), pickle_module=dill, mmap=True)
     cfg = payload['cfg']
     cls = hydra.utils.get_class(cfg._target_)
     workspace = cls(cfg, output_dir=output_dir)
     workspace: BaseWorkspace
     workspace.load_payload(payload, exclude_keys=None, include_keys=None)
+    return workspace
 
-    dataset = hydra.utils.instantiate(cfg.task.dataset)
-    train_dataloader = DataLoader(dataset, **cfg.dataloader)
 
-    # sample = train_dataloader['action']
+def generate(checkpoint, output_dir, save_traj, device='cuda:0', generation_file=None, num_samples=100, w=1):
+    #if os.path.exists(output_dir):
+    #    click.confirm(f"Output path {output_dir} already exists! Overwrite?", abort=True)
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    
+    # load checkpoint
+    workspace = load_workspace(checkpoint, output_dir)
+    cfg = workspace.cfg
+
+    # the cached workspace is only seeded when first built, reseed so every
+    # call draws the same noise regardless of earlier calls
+    seed = cfg.training.seed
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
 
     # get policy from workspace
     policy = workspace.model